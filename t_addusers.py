@@ -8,50 +8,224 @@
 #     "phone": "your_phone_number"
 # }
 
-import json
 import asyncio
 import random
-from telethon.sync import TelegramClient
+import time
+from collections.abc import Iterable
 from telethon.tl.functions.messages import AddChatUserRequest
 from telethon.tl.functions.channels import InviteToChannelRequest
-from telethon.errors import UserPrivacyRestrictedError, PeerFloodError, FloodWaitError
+from telethon.tl.types import InputUser
+from telethon import utils
+from telethon.errors import (
+    UserPrivacyRestrictedError, UserChannelsTooMuchError, UserNotMutualContactError, UserKickedError,
+    InputUserDeactivatedError, PeerFloodError, FloodWaitError, RPCError,
+)
+try:
+    from pyroaring import BitMap64
+except ImportError:
+    BitMap64 = None
 import logging
-logging.basicConfig(level=logging.INFO)
+from t_session import TelegramSession, setup_logging
+
 logger = logging.getLogger(__name__)
 
+# Invite pacing: INVITE_CONCURRENCY requests in flight to start with (adjusted
+# between 1 and INVITE_MAX_CONCURRENCY). Pacing is per user, not per request:
+# on average one user every 1 / INVITE_RATE seconds, i.e. 40 users per hour in
+# the long run. This is an average, not a cap: a whole batch of up to
+# INVITE_BATCH_SIZE users goes out at once and the following requests wait
+# until it has been paid for. Each wait is stretched by a random factor of up
+# to INVITE_JITTER to mimic a human, which brings the average down to about
+# 32 users per hour.
+INVITE_CONCURRENCY = 4
+INVITE_MAX_CONCURRENCY = 8
+INVITE_RATE = 1 / 90
+INVITE_BURST = 4
+INVITE_JITTER = 0.5
+# Maximum number of users sent in a single InviteToChannelRequest. A batch is
+# sent as soon as one token is available and paid for in full afterwards, so
+# the next request waits until every user in it has been accounted for.
+INVITE_BATCH_SIZE = 50
+# Number of times a batch is retried after a FloodWaitError before giving up
+INVITE_FLOOD_RETRIES = 3
+# Errors caused by a single user of a batch. A batch failing with one of these
+# is split to find that user; any other error is about the target group or the
+# account, and stops the run like a PeerFloodError. A TypeError means a user
+# without an access hash.
+USER_ERRORS = (
+    UserPrivacyRestrictedError, UserChannelsTooMuchError, UserNotMutualContactError,
+    UserKickedError, InputUserDeactivatedError, TypeError,
+)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, jitter: float = 0.0):
+        """
+        Initialize a token bucket rate limiter.
+
+        Tokens are refilled from the monotonic clock, so the schedule never
+        drifts with the time spent on each request; jitter only stretches the
+        waits, lowering the effective rate by at most a factor of 1 + jitter.
+
+        Args:
+            rate (float): Number of tokens added to the bucket per second.
+            burst (int): Maximum number of tokens the bucket can hold.
+            jitter (float, optional): Waits are stretched by a random factor
+                between 1 and 1 + jitter. Defaults to 0 (no jitter).
+        """
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, stop: asyncio.Event = None, tokens: int = 1) -> bool:
+        """
+        Wait until a token is available and take the given number of tokens.
+
+        Taking more tokens than are available leaves the bucket in debt, which
+        later callers wait out; the average rate is kept without needing a
+        bucket as large as the biggest request.
+
+        Args:
+            stop (asyncio.Event, optional): Give up waiting as soon as this event is set.
+            tokens (int, optional): Number of tokens to take. Pass 0 to only wait
+                out penalties and debt. Defaults to 1.
+
+        Returns:
+            bool: True if the tokens were taken, False if stop was set first.
+        """
+        async with self._lock:
+            while True:
+                if stop is not None and stop.is_set():
+                    return False
+                now = time.monotonic()
+                if now >= self._updated:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    needed = min(tokens, 1)
+                    if self._tokens >= needed:
+                        self._tokens -= tokens
+                        return True
+                    delay = (needed - self._tokens) / self.rate * random.uniform(1, 1 + self.jitter)
+                else:
+                    # The bucket has been penalized; nothing refills until then
+                    delay = self._updated - now
+                if stop is None:
+                    await asyncio.sleep(delay)
+                else:
+                    try:
+                        await asyncio.wait_for(stop.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+
+    async def penalize(self, seconds: float) -> None:
+        """
+        Empty the bucket and stop it from refilling for the given time.
+
+        Args:
+            seconds (float): Number of seconds before tokens are added again.
+        """
+        self._tokens = min(self._tokens, 0.0)
+        self._updated = max(self._updated, time.monotonic() + seconds)
+
+class AdmissionController:
+    def __init__(self, limit: int, max_limit: int):
+        """
+        Initialize an admission controller with an adjustable concurrency limit.
+
+        The limit grows by one after each successful request and is halved
+        whenever Telegram asks us to slow down (AIMD).
+
+        Args:
+            limit (int): Initial number of requests allowed in flight.
+            max_limit (int): Upper bound for the concurrency limit.
+        """
+        self.limit = limit
+        self.max_limit = max_limit
+        self._active = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        """
+        Wait until there is room for another request in flight.
+        """
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+
+    async def release(self) -> None:
+        """
+        Mark a request as finished and wake up one waiter.
+        """
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify(1)
+
+    async def on_success(self) -> None:
+        """
+        Additively increase the concurrency limit.
+        """
+        async with self._cond:
+            if self.limit < self.max_limit:
+                self.limit += 1
+                self._cond.notify(1)
+
+    async def on_flood_wait(self) -> None:
+        """
+        Multiplicatively decrease the concurrency limit.
+        """
+        async with self._cond:
+            self.limit = max(1, self.limit // 2)
+            self._cond.notify_all()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
 class TelegramGroupManager:
-    def __init__(self, secrets_file: str):
+    def __init__(self, secrets_file: str, session: TelegramSession = None):
         """
         Initialize the TelegramGroupManager with API credentials from a secrets file.
 
         Args:
             secrets_file (str): Path to the JSON file containing Telegram API credentials.
+            session (TelegramSession, optional): Session to use. Defaults to the
+                process-wide session for secrets_file.
         """
         try:
-            # Load credentials from JSON file
-            with open(secrets_file, 'r') as file:
-                secrets = json.load(file)
-            self._cached_group_types = {}
-            self.api_id = secrets['api_id']
-            self.api_hash = secrets['api_hash']
-            self.phone = secrets['phone']
-            self.client = TelegramClient('session_name', self.api_id, self.api_hash)
-            # Start the client synchronously
-            self.client.start(self.phone)
-            logger.info("Telegram client started successfully.")
+            self.session = session or TelegramSession.get(secrets_file)
+            self.client = self.session.client
+            self._cached_input_entities = {}
         except FileNotFoundError:
             logger.error(f"Secrets file not found: {secrets_file}")
             raise
         except KeyError as e:
             logger.error(f"Missing key in secrets file: {e}")
             raise
-        except RPCError as e:
-            logger.error(f"Failed to initialize Telegram client: {e}")
-            raise
         except Exception as e:
             logger.error(f"An unexpected error occurred during initialization: {e}")
             raise
 
+    async def connect(self) -> None:
+        """
+        Start the Telegram client and log in.
+        """
+        try:
+            await self.session.start()
+        except RPCError as e:
+            logger.error(f"Failed to initialize Telegram client: {e}")
+            raise
+
+    async def disconnect(self) -> None:
+        """
+        Disconnect from Telegram.
+        """
+        await self.session.disconnect()
+
     async def get_group_type(self, group_id: int, verbose: bool = True) -> str:
         """
         Identifies the type of a Telegram group or channel.
@@ -61,110 +235,236 @@ class TelegramGroupManager:
             verbose (bool): Whether to log the group type. Defaults to True.
 
         Returns:
-            str: String representing the group type ('basic_group', 'supergroup', 'channel').
+            str: The type of the group ('basic_group', 'supergroup', 'channel').
         """
-        if group_id in self._cached_group_types:
-            return self._cached_group_types[group_id]
-        entity = await self.client.get_entity(group_id)
-        try:
-            if entity.megagroup:
-                group_type = "supergroup"
-            elif entity.broadcast:
-                group_type = "channel"
-            else:
-                group_type = "basic_group"
-            self._cached_group_types[group_id] = group_type
-        except Exception as e:
-            group_type = "chat"
-        if verbose:
-            logger.info(f"Group {entity.title} is a {group_type}.")
-        return group_type
+        return await self.session.get_group_type(group_id, verbose)
+
+    async def get_input_entity(self, group_id: int):
+        """
+        Resolves a group or channel to its input peer, caching the result.
 
-    async def add_users_from_group(self, source_group_id: int, target_group_id: int, users_to_skip: list[int] = None) -> None:
+        Args:
+            group_id (int): Telegram ID or username of the group.
+
+        Returns:
+            The input peer (InputPeerChat or InputPeerChannel) for the group.
+        """
+        if group_id not in self._cached_input_entities:
+            self._cached_input_entities[group_id] = await self.client.get_input_entity(group_id)
+        return self._cached_input_entities[group_id]
+
+    async def add_users_from_group(self, source_group_id: int, target_group_id: int, users_to_skip: Iterable[int] = frozenset()) -> None:
         """
         Adds users from a source group to a target group.
 
         Args:
             source_group_id (int): Telegram ID of the source group.
             target_group_id (int): Telegram ID of the target group.
-            users_to_skip (list[int], optional): List of user IDs to exclude from the operation.
+            users_to_skip (Iterable[int], optional): User IDs to exclude from the operation.
+                Passing a frozenset avoids copying it.
         """
-        users_to_skip = set(users_to_skip or [])
-        logger.info("Fetching members from source group...")
-        source_members = await self.client.get_participants(source_group_id)
-        logger.info(f"Source group members: {len(source_members)}")
+        if not isinstance(users_to_skip, frozenset):
+            users_to_skip = frozenset(users_to_skip or ())
 
-        logger.info("Fetching members from target group...")
-        target_members = await self.client.get_participants(target_group_id)
-        logger.info(f"Target group members: {len(target_members)}")
+        async def _fetch_target_member_ids():
+            # Only the IDs of the target members are kept in memory, compressed
+            # into a bitmap when pyroaring is installed
+            member_ids = BitMap64() if BitMap64 is not None else set()
+            async for member in self.client.iter_participants(target_group_id):
+                member_ids.add(member.id)
+            return member_ids
 
-        # Create a set of user IDs in the target group
-        target_member_ids = {member.id for member in target_members}
-        group_entity = await self.client.get_entity(target_group_id)
+        async def _fetch_source_candidates() -> tuple[int, list]:
+            # Stream the source members, keeping only those not in the skip list
+            count = 0
+            candidates = []
+            async for member in self.client.iter_participants(source_group_id):
+                count += 1
+                if member.id not in users_to_skip:
+                    candidates.append(member)
+            return count, candidates
+
+        logger.info("Fetching members from source and target groups...")
+        (source_count, candidates), target_member_ids = await asyncio.gather(
+            _fetch_source_candidates(),
+            _fetch_target_member_ids(),
+        )
+        logger.info(f"Source group members: {source_count}")
+        logger.info(f"Target group members: {len(target_member_ids)}")
+
+        group_entity = await self.session.get_entity(target_group_id)
         group_name = group_entity.title
 
-        # Filter members not in the target group and not in the skip list
-        # Combine target members and users to skip into one set
-        skip_ids = set(target_member_ids).union(users_to_skip)
+        # Filter out source members already in the target group
+        is_target_member = target_member_ids.__contains__
         users_to_add = [
-            member for member in source_members
-            if member.id not in skip_ids
+            member for member in candidates
+            if not is_target_member(member.id)
         ]
         logger.info(f"Users to add: {len(users_to_add)}")
+        # Build each display name once; it is reused when inviting
+        user_names = {member.id: self.get_user_display_name(member) for member in users_to_add}
         for member in users_to_add:
-            user_name = member.username or f"{member.first_name or ''} {member.last_name or ''}".strip() or "Unknown User"
-            print(f"User: {member.id}, Name: {user_name}")
+            logger.debug(f"User: {member.id}, Name: {user_names[member.id]}")
 
         # Randomize the list of users to add
         random.shuffle(users_to_add)
-        print("\n\nList of users shuffled.")
+        logger.info("List of users shuffled.")
 
         # Identify the type of the target group
         target_group_type = await self.get_group_type(target_group_id, verbose=False)
 
+        # Resolve the target and the users once, so requests don't have to
+        target_input = await self.get_input_entity(target_group_id)
+        input_users = {user.id: InputUser(user.id, user.access_hash) for user in users_to_add}
+
+        # Pick the API once: basic groups take one user per request,
+        # supergroups and channels take a batch
+        if target_group_type in ("basic_group", "chat"):
+            batch_size = 1
+            target_chat_id = target_input.chat_id
+            action, target_desc = "Adding", f"basic group ({group_name})"
+
+            def make_request(batch: list):
+                return AddChatUserRequest(chat_id=target_chat_id, user_id=input_users[batch[0].id], fwd_limit=0)
+        else:
+            batch_size = INVITE_BATCH_SIZE
+            target_channel = utils.get_input_channel(target_input)
+            action, target_desc = "Inviting", f"{target_group_type} ({group_name})"
+
+            def make_request(batch: list):
+                return InviteToChannelRequest(channel=target_channel, users=[input_users[user.id] for user in batch])
+        batches = [users_to_add[i:i + batch_size] for i in range(0, len(users_to_add), batch_size)]
+
+        admission = AdmissionController(INVITE_CONCURRENCY, INVITE_MAX_CONCURRENCY)
+        bucket = TokenBucket(rate=INVITE_RATE, burst=INVITE_BURST, jitter=INVITE_JITTER)
+        stop = asyncio.Event()
+
+        async def _invite_batch(batch: list, tokens: int) -> None:
+            # tokens is what is still owed to the bucket for this batch; flood
+            # wait retries of an already paid batch pass 0
+            for attempt in range(INVITE_FLOOD_RETRIES + 1):
+                async with admission:
+                    # Give up as soon as the run is stopped, even while waiting for a token
+                    if not await bucket.acquire(stop, tokens):
+                        return
+                    tokens = 0
+                    names = ", ".join(f"{user_names[user.id]} ({user.id})" for user in batch)
+                    try:
+                        logger.info(f"{action} {names} to {target_desc}...")
+                        result = await self.client(make_request(batch))
+                        await admission.on_success()
+                    except PeerFloodError:
+                        logger.error("Rate limit exceeded. Stopping to avoid ban.")
+                        stop.set()
+                        return
+                    except FloodWaitError as e:
+                        logger.warning(f"Flood wait error: Pausing invites for {e.seconds} seconds.")
+                        await admission.on_flood_wait()
+                        await bucket.penalize(e.seconds)
+                        continue
+                    except UserPrivacyRestrictedError as e:
+                        if len(batch) == 1:
+                            logger.warning(f"Cannot add {names}: Privacy settings restricted.")
+                            return
+                        failure = e
+                        break
+                    except USER_ERRORS as e:
+                        if len(batch) == 1:
+                            logger.error(f"Error adding {names}: {e}")
+                            return
+                        failure = e
+                        break
+                    except Exception as e:
+                        # Retrying can't help with the target group or the account,
+                        # and hammering Telegram with failing requests risks a ban
+                        logger.error(f"Error adding users to {target_desc}: {e}. Stopping.")
+                        stop.set()
+                        return
+                    # Users that could not be added are reported individually
+                    # instead of failing the whole batch
+                    for missing in getattr(result, 'missing_invitees', []):
+                        user_name = user_names.get(missing.user_id, "Unknown User")
+                        logger.warning(f"Cannot add {user_name} ({missing.user_id}): Privacy settings restricted.")
+                    return
+            else:
+                logger.error(f"Giving up on {names} after {INVITE_FLOOD_RETRIES + 1} flood waits.")
+                return
+
+            # A single user made the whole request fail; split the batch so that
+            # only that user is lost. Each half pays a token, so the extra
+            # requests stay paced
+            logger.warning(f"Inviting {len(batch)} users failed ({failure}). Retrying in smaller batches.")
+            middle = len(batch) // 2
+            await _invite_batch(batch[:middle], 1)
+            await _invite_batch(batch[middle:], 1)
+
         # Add users to the target group using the appropriate API
-        for user in users_to_add:
-            user_name = user.username or f"{user.first_name or ''} {user.last_name or ''}".strip() or "Unknown User"
-            try:
-                if target_group_type in ["basic_group", "chat"]:
-                    logger.info(f"Adding {user_name} ({user.id}) to basic group ({group_name})...")
-                    await self.client(AddChatUserRequest(chat_id=target_group_id, user_id=user.id, fwd_limit=0))
-                else:  # supergroup or channel
-                    logger.info(f"Inviting {user_name} ({user.id}) to {target_group_type} ({group_name})...")
-                    await self.client(InviteToChannelRequest(channel=target_group_id, users=[user.id]))
-            except UserPrivacyRestrictedError:
-                logger.warning(f"Cannot add {user_name} ({user.id}): Privacy settings restricted.")
-            except PeerFloodError:
-                logger.error("Rate limit exceeded. Stopping to avoid ban.")
-                break
-            except FloodWaitError as e:
-                logger.warning(f"Flood wait error: Sleeping for {e.seconds} seconds.")
-                await asyncio.sleep(e.seconds)
-            except Exception as e:
-                logger.error(f"Error adding {user_name} ({user.id}): {e}")
-            # Avoid hitting Telegram rate limits
-            logger.info("Waiting (to mimic a human)....")
-            await asyncio.sleep(random.uniform(60, 180))  # Sleep between 60 to 180 seconds
-        logger.info("Process completed successfully.")
-
-    def run(self, source_group_id: int, target_group_id: int, users_to_skip: list[int] = None) -> None:
+        results = await asyncio.gather(*(_invite_batch(batch, len(batch)) for batch in batches), return_exceptions=True)
+        failures = [result for result in results if isinstance(result, Exception)]
+        for failure in failures:
+            logger.error(f"Unexpected error while adding users: {failure!r}", exc_info=failure)
+        if stop.is_set():
+            logger.error("Process stopped early to avoid a ban.")
+        elif failures:
+            logger.error(f"Process completed with {len(failures)} unexpected errors.")
+        else:
+            logger.info("Process completed successfully.")
+
+    def run(self, source_group_id: int, target_group_id: int, users_to_skip: Iterable[int] = frozenset()) -> None:
         """
         Runs the async function to add users from one group to another.
 
         Args:
             source_group_id (int): Telegram ID of the source group.
             target_group_id (int): Telegram ID of the target group.
-            users_to_skip (list[int], optional): List of user IDs to exclude from the operation.
+            users_to_skip (Iterable[int], optional): User IDs to exclude from the operation.
+                Passing a frozenset avoids copying it.
         """
-        self.client.loop.run_until_complete(
-            self.add_users_from_group(source_group_id, target_group_id, users_to_skip)
-        )
+        # The client is tied to the loop it first connected on, so every run uses the session's loop
+        self.session.loop.run_until_complete(self._main(source_group_id, target_group_id, users_to_skip))
+
+    async def _main(self, source_group_id: int, target_group_id: int, users_to_skip: Iterable[int]) -> None:
+        """
+        Connects, adds users from one group to another, and disconnects.
+
+        Args:
+            source_group_id (int): Telegram ID of the source group.
+            target_group_id (int): Telegram ID of the target group.
+            users_to_skip (Iterable[int]): User IDs to exclude from the operation.
+        """
+        await self.connect()
+        try:
+            await self.add_users_from_group(source_group_id, target_group_id, users_to_skip)
+        finally:
+            await self.disconnect()
+
+    @staticmethod
+    def get_user_display_name(user) -> str:
+        """
+        Generate a display name for a user.
+
+        Args:
+            user: The user entity from Telegram.
+
+        Returns:
+            str: A readable display name for the user.
+        """
+        return user.username or f"{user.first_name or ''} {user.last_name or ''}".strip() or "Unknown User"
 
 if __name__ == "__main__":
+    setup_logging()
     secrets_file = "api_secrets.json"
     source_group_id = -1002433161186  # Source group ID (Old Quantum Wizards)
     target_group_id = -1002429973404  # Target group ID (New Quantum Wizards)
-    users_to_skip = []  # User ID to skip (optional)
+    users_to_skip = frozenset()  # User IDs to skip (optional)
+
+    # Use uvloop's faster event loop when it is installed (not available on Windows)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
 
     manager = TelegramGroupManager(secrets_file)
     manager.run(source_group_id, target_group_id, users_to_skip)
@@ -10,45 +10,44 @@
 # }
 
 
-# import asyncio
-import json
+import asyncio
 import logging
-from telethon.sync import TelegramClient
 from telethon.errors.rpcerrorlist import (
     FloodWaitError,
     PeerFloodError,
     UserPrivacyRestrictedError,
     ChatWriteForbiddenError,
 )
+from t_session import TelegramSession, setup_logging
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Maximum number of group type lookups in flight when listing dialogs
+GROUP_TYPE_PROBE_CONCURRENCY = 16
+
 class TelegramConnector:
-    def __init__(self, secrets_file: str):
+    def __init__(self, secrets_file: str, session: TelegramSession = None):
         """
         Initialize the TelegramConnector.
 
         Args:
             secrets_file (str): Path to the JSON file containing API credentials.
+            session (TelegramSession, optional): Session to use. Defaults to the
+                process-wide session for secrets_file.
         """
-        with open(secrets_file, 'r') as file:
-            secrets = json.load(file)
-        self.api_id = secrets['api_id']
-        self.api_hash = secrets['api_hash']
-        self.phone = secrets['phone']
-        self.client = TelegramClient('session_name', self.api_id, self.api_hash)
-        self._cached_group_types = {}
+        self.session = session or TelegramSession.get(secrets_file)
+        self.client = self.session.client
 
     async def connect(self) -> None:
         """
         Establish a connection to Telegram.
         """
-        await self.client.start(self.phone)
+        await self.session.start()
         logger.info("Connected to Telegram.")
         try:
             me = await self.client.get_me()
             self.id = me.id
+            self.session.cache_entity(me.id, me)
             user_name = self.get_user_display_name(me)
             logger.info(f"Logged in as {user_name} ({me.id})")
         except Exception as e:
@@ -85,24 +84,29 @@ class TelegramConnector:
         try:
             dialogs = await self.client.get_dialogs()
             logger.info(f"Fetched {len(dialogs)} dialogs successfully.")
-            
+            # Dialogs already carry their entities; keep them so later lookups
+            # (group types, write checks) don't need another request
             for dialog in dialogs:
+                self.session.cache_entity(dialog.id, dialog.entity)
+            
+            # Look up the group types concurrently, a bounded number at a time
+            sem = asyncio.Semaphore(GROUP_TYPE_PROBE_CONCURRENCY)
+
+            async def probe(dialog):
+                async with sem:
+                    return dialog, await self.get_group_type(dialog.id, verbose = False)
+
+            results = await asyncio.gather(*(probe(dialog) for dialog in dialogs if dialog.is_group or dialog.is_channel))
+
+            for dialog, group_type in results:
                 if dialog.is_group:
-                    print(f"Group Name: {dialog.name}")
-                    print(f"Group ID: {dialog.id}")
-                    print(f"Group Type: {await self.get_group_type(dialog.id, verbose = False)}")
                     if hasattr(dialog.entity, 'access_hash'):
-                        print(f"Access Hash: {dialog.entity.access_hash}")
+                        access_hash = dialog.entity.access_hash
                     else:
-                        print("No Access Hash (likely a basic group)")
-                elif dialog.is_channel:
-                    print(f"Channel Name: {dialog.name}")
-                    print(f"Channel ID: {dialog.id}")
-                    print(f"Channel Type: {await self.get_group_type(dialog.id, verbose = False)}")
-                    print(f"Access Hash: {dialog.entity.access_hash}")
+                        access_hash = "None (likely a basic group)"
+                    logger.info(f"Group Info:\n\tName: {dialog.name}\n\tID: {dialog.id}\n\tType: {group_type}\n\tAccess Hash: {access_hash}")
                 else:
-                    continue
-                print("-" * 40)
+                    logger.info(f"Channel Info:\n\tName: {dialog.name}\n\tID: {dialog.id}\n\tType: {group_type}\n\tAccess Hash: {dialog.entity.access_hash}")
             return True
         except FloodWaitError as e:
             logger.warning(f"Flood wait detected. Retry after {e.seconds} seconds.")
@@ -126,7 +130,7 @@ class TelegramConnector:
         """
         user_id = user_id if user_id else self.id
         try:
-            user = await self.client.get_entity(user_id)
+            user = await self.session.get_entity(user_id)
             user_name = self.get_user_display_name(user)
             logger.info(f"User Info:\n\tID: {user.id}\n\tUsername: {user_name}")
             logger.info("The user does not appear to have any restrictions.")
@@ -149,7 +153,7 @@ class TelegramConnector:
             bool: True if write permissions are available, False otherwise.
         """
         try:
-            group = await self.client.get_entity(group_id)
+            group = await self.session.get_entity(group_id)
             logger.info(f"Group Info ({group_id}):\n\tID: {group.id}\n\tTitle: {group.title}")
             logger.info("The group does not appear to have any restrictions.")
             return True
@@ -171,28 +175,13 @@ class TelegramConnector:
         Returns:
             str: The type of the group ('basic_group', 'supergroup', 'channel').
         """
-        if group_id in self._cached_group_types:
-            return self._cached_group_types[group_id]
-        entity = await self.client.get_entity(group_id)
-        try:
-            if entity.megagroup:
-                group_type = "supergroup"
-            elif entity.broadcast:
-                group_type = "channel"
-            else:
-                group_type = "basic_group"
-            self._cached_group_types[group_id] = group_type
-        except Exception as e:
-            group_type = "chat"
-        if verbose:
-            logger.info(f"Group {entity.title} is a {group_type}.")
-        return group_type
+        return await self.session.get_group_type(group_id, verbose)
 
     async def disconnect(self) -> None:
         """
         Disconnect from Telegram.
         """
-        await self.client.disconnect()
+        await self.session.disconnect()
         logger.info("Disconnected from Telegram.")
     
     @staticmethod
@@ -212,7 +201,15 @@ class TelegramConnector:
 
 # Example usage
 if __name__ == "__main__":
+    setup_logging()
     secrets_file = 'api_secrets.json'
+    # Use uvloop's faster event loop when it is installed (not available on Windows)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     checker = TelegramConnector(secrets_file)
 
     async def main():
@@ -224,5 +221,4 @@ if __name__ == "__main__":
         await checker.can_write_to_group(group_id=-1002433161186)
         await checker.disconnect()
 
-    import asyncio
-    asyncio.run(main())
+    checker.session.loop.run_until_complete(main())
@@ -0,0 +1,256 @@
+# Copyright (C) Jim Moraga, 2024
+# https://github.com/ilssear/TelegramManager
+
+# Example api_secrets.json:
+# {
+#     "api_id": "your_api_id",
+#     "api_hash": "your_api_hash",
+#     "phone": "your_phone_number"
+# }
+
+import asyncio
+import atexit
+import functools
+import logging
+import queue
+import shelve
+import time
+from logging.handlers import QueueHandler, QueueListener
+import orjson
+from async_lru import alru_cache
+from telethon import TelegramClient
+
+logger = logging.getLogger(__name__)
+
+# Group types are persisted across runs and trusted for up to a week
+GROUP_TYPE_CACHE_FILE = 'group_types.cache'
+GROUP_TYPE_CACHE_TTL = 7 * 24 * 60 * 60
+
+_log_listener = None
+
+def setup_logging(level: int = logging.INFO) -> None:
+    """
+    Configure logging for the scripts, once per process.
+
+    Log records are queued by the event loop thread and written to stderr by
+    a background listener thread, so logging never blocks the event loop.
+
+    Args:
+        level (int, optional): Root logging level. Defaults to logging.INFO.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+    log_queue = queue.Queue(-1)
+    logging.basicConfig(level=level, handlers=[QueueHandler(log_queue)])
+    _log_listener = QueueListener(log_queue, logging.StreamHandler())
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+@functools.cache
+def _load_secrets(secrets_file: str) -> dict:
+    """
+    Load API credentials from a secrets file, once per path.
+
+    The file is assumed not to change while the process is running.
+
+    Args:
+        secrets_file (str): Path to the JSON file containing Telegram API credentials.
+
+    Returns:
+        dict: The parsed credentials.
+    """
+    with open(secrets_file, 'rb') as file:
+        return orjson.loads(file.read())
+
+# Open group type caches, by file name. Each account gets its own file, so
+# accounts can run side by side in separate processes; the caches are closed
+# when the process exits
+_group_type_caches = {}
+
+def _open_group_type_cache(session_name: str) -> shelve.Shelf:
+    """
+    Open the persistent group type cache of a Telethon session, once per process.
+
+    The cache is stored next to the session file, as
+    "<session_name>.group_types.cache".
+
+    Args:
+        session_name (str): Name of the Telethon session file.
+
+    Returns:
+        shelve.Shelf: The group type cache for session_name.
+    """
+    filename = f"{session_name}.{GROUP_TYPE_CACHE_FILE}"
+    cache = _group_type_caches.get(filename)
+    if cache is None:
+        cache = _group_type_caches[filename] = shelve.open(filename)
+        atexit.register(cache.close)
+    return cache
+
+# Telethon clients stay tied to the event loop they first connect on, so every
+# session shares one loop; clients for several accounts can then be used together
+_event_loop = None
+
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Return the event loop shared by every session, once per process.
+
+    The running loop is used if there is one; otherwise a new loop is created
+    and made the current one.
+
+    Returns:
+        asyncio.AbstractEventLoop: The shared event loop.
+    """
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        try:
+            _event_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            _event_loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(_event_loop)
+    return _event_loop
+
+class TelegramSession:
+    _instances = {}
+
+    def __init__(self, secrets_file: str):
+        """
+        Initialize the TelegramSession with API credentials from a secrets file.
+
+        The secrets file may also set "session_name", the Telethon session file
+        to use. Each account needs its own; it defaults to 'session_name'.
+
+        Args:
+            secrets_file (str): Path to the JSON file containing Telegram API credentials.
+        """
+        secrets = _load_secrets(secrets_file)
+        self.api_id = secrets['api_id']
+        self.api_hash = secrets['api_hash']
+        self.phone = secrets['phone']
+        self.session_name = secrets.get('session_name', 'session_name')
+        # Loop for synchronous callers to run on, shared by every session
+        self.loop = _get_event_loop()
+        self.client = TelegramClient(self.session_name, self.api_id, self.api_hash)
+        self.group_type_cache = _open_group_type_cache(self.session_name)
+        self._cached_entities = {}
+        self._entity_locks = {}
+        # Cached per session, so the cache doesn't keep other sessions alive
+        self._get_group_type_cached = alru_cache(maxsize=1024)(self._fetch_group_type)
+        self._started = False
+
+    @classmethod
+    def get(cls, secrets_file: str) -> "TelegramSession":
+        """
+        Return the session for a secrets file, shared by every manager in this
+        process, creating it if needed.
+
+        Args:
+            secrets_file (str): Path to the JSON file containing Telegram API credentials.
+
+        Returns:
+            TelegramSession: The shared session for secrets_file.
+        """
+        session = cls._instances.get(secrets_file)
+        if session is None:
+            session = cls._instances[secrets_file] = cls(secrets_file)
+        return session
+
+    async def start(self) -> None:
+        """
+        Start the client and log in, unless that has already been done.
+        """
+        if not self._started:
+            await self.client.start(self.phone)
+            self._started = True
+            logger.info("Telegram client started successfully.")
+
+    async def get_entity(self, entity_id: int):
+        """
+        Fetch an entity from Telegram, caching the result for later calls.
+
+        Args:
+            entity_id (int): Telegram ID or username of the user, group or channel.
+
+        Returns:
+            The entity returned by Telegram.
+        """
+        entity = self._cached_entities.get(entity_id)
+        if entity is None:
+            # Concurrent lookups of the same entity wait for the first one
+            lock = self._entity_locks.get(entity_id)
+            if lock is None:
+                lock = self._entity_locks[entity_id] = asyncio.Lock()
+            async with lock:
+                entity = self._cached_entities.get(entity_id)
+                if entity is None:
+                    entity = await self.client.get_entity(entity_id)
+                    self._cached_entities[entity_id] = entity
+                    # Later lookups hit the cache, so the lock is no longer needed
+                    self._entity_locks.pop(entity_id, None)
+        return entity
+
+    def cache_entity(self, entity_id: int, entity) -> None:
+        """
+        Remember an entity obtained by other means (e.g. get_me or get_dialogs).
+
+        Args:
+            entity_id (int): Telegram ID of the entity.
+            entity: The user, group or channel entity.
+        """
+        self._cached_entities.setdefault(entity_id, entity)
+
+    async def get_group_type(self, group_id: int, verbose: bool = True) -> str:
+        """
+        Identifies the type of a Telegram group or channel.
+
+        Args:
+            group_id (int): Telegram ID or username of the group.
+            verbose (bool): Whether to log the group type. Defaults to True.
+
+        Returns:
+            str: The type of the group ('basic_group', 'supergroup', 'channel').
+        """
+        group_type = await self._get_group_type_cached(group_id)
+        if verbose:
+            entity = await self.get_entity(group_id)
+            logger.info(f"Group {entity.title} is a {group_type}.")
+        return group_type
+
+    async def _fetch_group_type(self, group_id: int) -> str:
+        """
+        Determine the type of a group, from the persisted cache or from Telegram.
+
+        Called through the per-session _get_group_type_cached LRU cache.
+
+        Args:
+            group_id (int): Telegram ID or username of the group.
+
+        Returns:
+            str: The type of the group ('basic_group', 'supergroup', 'channel', or 'chat').
+        """
+        # Fall back to the group types saved by previous runs
+        cached = self.group_type_cache.get(str(group_id))
+        if cached is not None and time.time() - cached[0] < GROUP_TYPE_CACHE_TTL:
+            return cached[1]
+        entity = await self.get_entity(group_id)
+        try:
+            if entity.megagroup:
+                group_type = "supergroup"
+            elif entity.broadcast:
+                group_type = "channel"
+            else:
+                group_type = "basic_group"
+            self.group_type_cache[str(group_id)] = (time.time(), group_type)
+            self.group_type_cache.sync()
+        except Exception as e:
+            group_type = "chat"
+        return group_type
+
+    async def disconnect(self) -> None:
+        """
+        Disconnect the client. The session stays usable and reconnects on the next start().
+        """
+        await self.client.disconnect()
+        self._get_group_type_cached.cache_clear()
+        self._started = False
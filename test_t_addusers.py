@@ -0,0 +1,246 @@
+# Copyright (C) Jim Moraga, 2024
+# https://github.com/ilssear/TelegramManager
+
+# Run with: python -m unittest test_t_addusers
+
+import asyncio
+import types
+import unittest
+from unittest import mock
+from telethon.errors import ChatAdminRequiredError, FloodWaitError, UserChannelsTooMuchError
+from telethon.tl.types import InputPeerChannel
+import t_addusers
+from t_addusers import AdmissionController, TelegramGroupManager, TokenBucket
+
+class FakeClock:
+    def __init__(self):
+        """
+        A monotonic clock that only moves when t_addusers sleeps, so waits of
+        minutes take no real time.
+        """
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float) -> None:
+        self.now += delay
+        await asyncio.sleep(0)
+
+    async def wait_for(self, aw, timeout: float):
+        # Time jumps to the timeout unless the awaitable finishes right away
+        task = asyncio.ensure_future(aw)
+        await asyncio.sleep(0)
+        if task.done():
+            return task.result()
+        task.cancel()
+        self.now += timeout
+        raise asyncio.TimeoutError
+
+class FakeClockTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        """
+        Route t_addusers' clock and sleeps through a FakeClock.
+        """
+        self.clock = FakeClock()
+        fake_time = types.SimpleNamespace(monotonic=self.clock.monotonic)
+        fake_asyncio = types.SimpleNamespace(**vars(asyncio))
+        fake_asyncio.sleep = self.clock.sleep
+        fake_asyncio.wait_for = self.clock.wait_for
+        for name, fake in (('time', fake_time), ('asyncio', fake_asyncio)):
+            patcher = mock.patch.object(t_addusers, name, fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+class TokenBucketTest(FakeClockTestCase):
+    async def test_multi_token_acquire_leaves_debt(self):
+        bucket = TokenBucket(rate=1, burst=4)
+        start = self.clock.now
+        self.assertTrue(await bucket.acquire(tokens=10))
+        self.assertEqual(self.clock.now, start)
+        # 4 - 10 leaves 6 tokens of debt; one more token takes 7 seconds
+        self.assertTrue(await bucket.acquire())
+        self.assertAlmostEqual(self.clock.now - start, 7)
+
+    async def test_zero_tokens_only_waits_out_debt(self):
+        bucket = TokenBucket(rate=1, burst=1)
+        start = self.clock.now
+        await bucket.acquire(tokens=3)
+        self.assertTrue(await bucket.acquire(tokens=0))
+        self.assertAlmostEqual(self.clock.now - start, 2)
+
+    async def test_penalize_delays_waiters(self):
+        bucket = TokenBucket(rate=1, burst=1)
+        await bucket.acquire()
+        start = self.clock.now
+        await bucket.penalize(30)
+        self.assertTrue(await bucket.acquire())
+        # Nothing refills during the penalty, then one token takes a second
+        self.assertAlmostEqual(self.clock.now - start, 31)
+
+    async def test_penalize_keeps_debt(self):
+        bucket = TokenBucket(rate=1, burst=1)
+        await bucket.acquire(tokens=5)
+        start = self.clock.now
+        await bucket.penalize(10)
+        self.assertTrue(await bucket.acquire())
+        self.assertAlmostEqual(self.clock.now - start, 15)
+
+    async def test_acquire_returns_false_once_stopped(self):
+        bucket = TokenBucket(rate=1 / 90, burst=1)
+        stop = asyncio.Event()
+        self.assertTrue(await bucket.acquire(stop))
+        stop.set()
+        self.assertFalse(await bucket.acquire(stop))
+
+    async def test_stop_interrupts_waiting(self):
+        bucket = TokenBucket(rate=1 / 90, burst=1)
+        stop = asyncio.Event()
+        await bucket.acquire(stop)
+        # Bypass the fake wait_for so the waiter really blocks on the stop event
+        with mock.patch.object(t_addusers.asyncio, 'wait_for', asyncio.wait_for):
+            waiter = asyncio.create_task(bucket.acquire(stop))
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiter.done())
+            stop.set()
+            self.assertFalse(await asyncio.wait_for(waiter, 1))
+
+class AdmissionControllerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_aimd_limit(self):
+        admission = AdmissionController(limit=4, max_limit=6)
+        await admission.on_success()
+        self.assertEqual(admission.limit, 5)
+        for _ in range(3):
+            await admission.on_success()
+        self.assertEqual(admission.limit, 6)
+        await admission.on_flood_wait()
+        self.assertEqual(admission.limit, 3)
+        for _ in range(3):
+            await admission.on_flood_wait()
+        self.assertEqual(admission.limit, 1)
+
+    async def test_limit_blocks_until_raised(self):
+        admission = AdmissionController(limit=1, max_limit=2)
+        await admission.acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+        await admission.on_success()
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual(admission._active, 2)
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.access_hash = user_id
+        self.username = f"user{user_id}"
+        self.first_name = self.last_name = None
+
+class FakeClient:
+    def __init__(self, source_ids, target_ids, error=None, error_user=None, flood_waits=0):
+        """
+        A client that invites users into a list and can fail on demand.
+
+        Args:
+            error (Exception, optional): Raised for every request, or only for
+                requests including error_user when that is set.
+            flood_waits (int, optional): Number of requests answered with a FloodWaitError.
+        """
+        self.members = {1: source_ids, 2: target_ids}
+        self.error = error
+        self.error_user = error_user
+        self.flood_waits = flood_waits
+        self.requests = []
+        self.added = []
+
+    def iter_participants(self, group_id):
+        async def _iter():
+            for user_id in self.members[group_id]:
+                yield FakeUser(user_id)
+        return _iter()
+
+    async def get_input_entity(self, group_id):
+        return InputPeerChannel(group_id, 0)
+
+    async def __call__(self, request):
+        user_ids = [user.user_id for user in request.users]
+        self.requests.append(user_ids)
+        if self.flood_waits:
+            self.flood_waits -= 1
+            raise FloodWaitError(request=None, capture=60)
+        if self.error is not None and (self.error_user is None or self.error_user in user_ids):
+            raise self.error
+        self.added += user_ids
+        return types.SimpleNamespace(missing_invitees=[])
+
+class FakeSession:
+    def __init__(self, client):
+        self.client = client
+
+    async def get_entity(self, group_id):
+        return types.SimpleNamespace(title=f"Group {group_id}")
+
+    async def get_group_type(self, group_id, verbose=True):
+        return "supergroup"
+
+class AddUsersTest(FakeClockTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, value in (('INVITE_BATCH_SIZE', 8), ('INVITE_JITTER', 0)):
+            patcher = mock.patch.object(t_addusers, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def add_users(self, client) -> list:
+        """
+        Run add_users_from_group with a fake client and return the log messages.
+        """
+        manager = TelegramGroupManager("unused.json", session=FakeSession(client))
+        with self.assertLogs('t_addusers', level='INFO') as logs:
+            await manager.add_users_from_group(1, 2)
+        return logs.output
+
+    async def test_adds_missing_users(self):
+        client = FakeClient(range(1, 41), range(1, 11))
+        await self.add_users(client)
+        self.assertEqual(sorted(client.added), list(range(11, 41)))
+        self.assertEqual(len(client.requests), 4)
+
+    async def test_pacing_is_per_user(self):
+        client = FakeClient(range(1, 41), ())
+        start = self.clock.now
+        await self.add_users(client)
+        # Five batches of 8 with INVITE_BURST = 4 tokens to start with: the
+        # last batch is sent once 4 + elapsed * rate - 32 reaches one token
+        self.assertAlmostEqual(self.clock.now - start, 29 / t_addusers.INVITE_RATE)
+
+    async def test_flood_wait_retries_and_halves_concurrency(self):
+        limits = []
+
+        class RecordingAdmission(AdmissionController):
+            async def on_flood_wait(self):
+                await super().on_flood_wait()
+                limits.append(self.limit)
+
+        client = FakeClient(range(1, 17), (), flood_waits=1)
+        with mock.patch.object(t_addusers, 'AdmissionController', RecordingAdmission):
+            await self.add_users(client)
+        self.assertEqual(sorted(client.added), list(range(1, 17)))
+        self.assertEqual(limits, [t_addusers.INVITE_CONCURRENCY // 2])
+
+    async def test_user_error_splits_batch(self):
+        client = FakeClient(range(1, 9), (), error=UserChannelsTooMuchError(request=None), error_user=5)
+        await self.add_users(client)
+        self.assertEqual(sorted(client.added), [1, 2, 3, 4, 6, 7, 8])
+        # 8 -> 4 + 4 -> the bad half splits down to the single bad user
+        self.assertEqual(len(client.requests), 7)
+
+    async def test_target_error_stops(self):
+        client = FakeClient(range(1, 33), (), error=ChatAdminRequiredError(request=None))
+        logs = await self.add_users(client)
+        self.assertEqual(len(client.requests), 1)
+        self.assertFalse(client.added)
+        self.assertTrue(any("stopped early" in line for line in logs))
+
+if __name__ == "__main__":
+    unittest.main()